@@ -13,8 +13,6 @@ from utils.glan_functions import *
 from utils.graph_functions import *
 from utils.search_funcs import *
 
-torch.set_grad_enabled(False)
-
 
 class AdapTopKGraph(torch.nn.Module):
     def __init__(self, step):
@@ -48,8 +46,8 @@ class AdapTopKGraph(torch.nn.Module):
         edge_index, edge_attr, idx_row, idx_knn, k = self.build_graph(distance_matrix)
 
         if torch.cuda.is_available():
-            data = Data(x=torch.zeros((sum(distance_matrix.shape), 8)).cuda(), edge_index=edge_index.cuda(),
-                        edge_attr=edge_attr.cuda(),
+            data = Data(x=torch.zeros((sum(distance_matrix.shape), 8), device='cuda'),
+                        edge_index=edge_index.cuda(), edge_attr=edge_attr.cuda(),
                         kwargs=[distance_matrix.shape[0], distance_matrix.shape[1], k, idx_row, idx_knn,
                                 edge_attr.shape[0]],
                         cost_vec=distance_matrix.view(-1, 1).cuda())
@@ -80,7 +78,7 @@ class GraphData(Dataset):
 
 class GnnEditor:
     def __init__(self, data, gnn_model, predictor=None, tokenizer=None, pos=None, antonyms=None, subs=None,
-                 word_embeddings=None):
+                 word_embeddings=None, encodings=None, workers=1):
         """
         Initialize the GnnEditor object.
 
@@ -92,6 +90,8 @@ class GnnEditor:
         :param antonyms: whether to substitute with antonyms or not
         :param subs: dictionary containing precomputed substitution pairs
         :param word_embeddings: dictionary containing word embeddings
+        :param encodings: pre-computed tokenizer encodings of the data, used for the original predictions
+        :param workers: number of processes used for pos tagging the data, defaults to a single process
         """
         self.data = data
         self.model = gnn_model
@@ -110,6 +110,8 @@ class GnnEditor:
 
         self.substitutions = subs
         self.word_embeddings = word_embeddings
+        self.encodings = encodings
+        self.workers = workers
 
     def create_distance_matrix(self, edge_filter=False):
         """
@@ -122,22 +124,17 @@ class GnnEditor:
 
         # use appropriate function based on pos to get the list of the specified pos words from the data
         if self.pos is not None:
-            if self.pos == 'adj':
-                lst = create_attributes_list(sentences)
-            elif self.pos == 'verb':
-                lst = create_verb_list(sentences)
-            elif self.pos == 'noun':
-                lst = create_singular_list(sentences)
-            else:
+            if self.pos not in ('adj', 'verb', 'noun'):
                 raise AttributeError("pos '{}' is not supported!".format(self.pos))
+            lst = create_pos_lists(sentences, [self.pos], n_workers=self.workers)[0]
 
             syn0 = list(lst)
             syn1 = get_antonym_list(lst) if self.antonyms else syn0
 
         else:
-            attributes_lst = create_attributes_list(sentences)
-            verb_lst = create_verb_list(sentences)
-            noun_lst = create_singular_list(sentences)
+            # tag every sentence once for all three lists, instead of once per list
+            attributes_lst, verb_lst, noun_lst = create_pos_lists(sentences, ['adj', 'verb', 'noun'],
+                                                                  n_workers=self.workers)
 
             syn0 = attributes_lst + verb_lst + noun_lst
             syn1 = syn0 if not self.antonyms else get_antonym_list(attributes_lst) + verb_lst + noun_lst
@@ -151,7 +148,16 @@ class GnnEditor:
         print("Creating Distance Matrix...")
         self.distance_matrix = torch.zeros((row_length, col_length))
 
-        if self.word_embeddings is None:
+        words0 = [self.d0[s] for s in self.all_syn0]
+        words1 = [self.d1[s] for s in self.all_syn1]
+
+        if self.word_embeddings is None and not edge_filter:
+            for i in range(row_length):
+                for j in range(col_length):
+                    # rows will be syn0 and columns will be syn1
+                    self.distance_matrix[i, j] = wn_path_similarity(self.all_syn0[i], self.all_syn1[j])
+
+        elif self.word_embeddings is None:
             model_id = "mixedbread-ai/mxbai-embed-large-v1"
             embed_tokenizer = AutoTokenizer.from_pretrained(model_id)
             embed_model = AutoModel.from_pretrained(model_id)
@@ -159,33 +165,29 @@ class GnnEditor:
             device = 'cuda' if torch.cuda.is_available() else 'cpu'
             embed_model.to(device)
 
-            for i in range(row_length):
-                for j in range(col_length):
-                    # rows will be syn0 and columns will be syn1
-                    self.distance_matrix[i, j] = get_cos_similarity(
-                        self.all_syn0[i], self.all_syn1[j], self.d0[self.all_syn0[i]],
-                        self.d1[self.all_syn1[j]], embed_model, embed_tokenizer) if edge_filter else\
-                        wn_path_similarity(self.all_syn0[i], self.all_syn1[j])
+            # embed each word once, and compute the distances of all pairs at once from the embeddings
+            unique_words = list(dict.fromkeys(words0 + words1))
+            word_idx = {w: i for i, w in enumerate(unique_words)}
+            embeddings = get_word_embeddings(unique_words, embed_model, embed_tokenizer)
+
+            # rows will be syn0 and columns will be syn1
+            self.distance_matrix = cos_distance_matrix(embeddings[[word_idx[w] for w in words0]],
+                                                       embeddings[[word_idx[w] for w in words1]])
+            self.distance_matrix[pos_mismatch_matrix(self.all_syn0, self.all_syn1)] = 10
 
             del embed_model
             del embed_tokenizer
 
         else:
             # if embeddings are already precomputed
-            for i in range(row_length):
-                for j in range(col_length):
-                    # get the word embeddings
-                    try:
-                        i_word_vector = self.word_embeddings[self.d0[self.all_syn0[i]]]
-                        j_word_vector = self.word_embeddings[self.d1[self.all_syn1[j]]]
-                    except KeyError:
-                        self.distance_matrix[i, j] = 10
-                        continue
-
-                    if edge_filter and self.all_syn0[i].pos() != self.all_syn1[j].pos():
-                        self.distance_matrix[i, j] = 10
-                    else:
-                        self.distance_matrix[i, j] = 2 - cosine(i_word_vector, j_word_vector)
+            vectors0, found0 = lookup_word_embeddings(words0, self.word_embeddings)
+            vectors1, found1 = lookup_word_embeddings(words1, self.word_embeddings)
+
+            self.distance_matrix = cos_distance_matrix(vectors0, vectors1)
+            if edge_filter:
+                self.distance_matrix[pos_mismatch_matrix(self.all_syn0, self.all_syn1)] = 10
+            self.distance_matrix[~found0, :] = 10
+            self.distance_matrix[:, ~found1] = 10
 
         return self
 
@@ -215,7 +217,7 @@ class GnnEditor:
             pred = pred.view(-1, 1)
 
             # convert model output to a matrix denoting whether an edge is part of the minimum match or not
-            tag_scores = torch.zeros((1, shape1, shape2)).cuda()
+            tag_scores = torch.zeros((1, shape1, shape2), device=pred.device)
             tag_scores[:, idx_row, idx_knn] = pred
             tag_scores = tag_scores.squeeze(0)
 
@@ -242,18 +244,27 @@ class GnnEditor:
         print("Creating Counterfactuals...")
 
         sentences = [elem[0] for elem in self.data.values.tolist()]
+
+        # get the original predictions of all sentences at once, if the data are already encoded
+        original_logits = None
+        if self.encodings is not None:
+            original_logits = get_batch_logits(model=self.predictor, tokenizer=self.tokenizer,
+                                               encoded_text=self.encodings)
+
         counter_sents = []
-        for s in tqdm(sentences):
-            # get original prediction probabilities
-            logits = get_prediction(model=self.predictor, tokenizer=self.tokenizer, text=s, return_logits=True)
-            probs = torch.softmax(logits, dim=1)[0]
+        for idx, s in enumerate(tqdm(sentences)):
+            # get original prediction logits
+            if original_logits is not None:
+                logits = original_logits[idx]
+            else:
+                logits = get_prediction(model=self.predictor, tokenizer=self.tokenizer, text=s, return_logits=True)[0]
 
             # get original fluency
             fluency = sent_scoring(self.fluency_model, self.fluency_tokenizer, s)[0]
 
             # get the best counterfactual using beam search
             max_subs = math.ceil(len(s.split()) / 5) if opt_th else 10
-            cs = beam_search(text=s, substitutions=self.substitutions, original_probs=probs, original_fluency=fluency,
+            cs = beam_search(text=s, substitutions=self.substitutions, original_logits=logits, original_fluency=fluency,
                              model=self.predictor, tokenizer=self.tokenizer, fluency_model=self.fluency_model,
                              fluency_tokenizer=self.fluency_tokenizer, max_subs=max_subs,
                              use_contrastive_prob=use_contrastive_prob)
@@ -265,6 +276,7 @@ class GnnEditor:
 
         return counter_data, self.substitutions
 
+    @torch.inference_mode()
     def pipeline(self, edge_filter=False, opt_th=False, use_contrastive_prob=False):
         """
         A method that provides sequential execution of the other methods to perform counterfactual generation.
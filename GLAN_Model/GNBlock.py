@@ -136,10 +136,10 @@ class Model(torch.nn.Module):
     def forward(self, data):
 
         x_, edge_index, edge_attr = data.x, data.edge_index, data.edge_attr
-        batch_node = data.batch.cuda()
+        batch_node = data.batch.to(x_.device)
         batch_edge = self.cal_edge_batch(data)
         num_node = x_.shape[0]
-        x = torch.zeros((num_node, self.dim_node)).cuda()
+        x = torch.zeros((num_node, self.dim_node), device=x_.device)
         time_start = time.time()
         edge_attr = self.encoder_edge(edge_attr)
         for idx in range(self.layer_num):
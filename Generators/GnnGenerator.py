@@ -27,6 +27,9 @@ antonyms is False:
         [--antonyms]
         [--edge-filter]
         [--optimal-threshold]
+        [--compile]
+        [--workers <number of processes used for pos tagging>]
+        [--quantize]
 
 Example:
 1) Generate the most generic counterfactuals by giving only the required parameters and leaving the rest to default:
@@ -73,20 +76,25 @@ Example:
 """
 
 import os
+import csv
 import json
 import argparse
+import platform
+import tempfile
+import torch
+import pandas as pd
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from GLAN_Model.GNBlock import Model
-from Editors.GnnEditor import *
+from Editors.GnnEditor import GnnEditor
 from transformers import DistilBertForSequenceClassification, DistilBertTokenizerFast
 
-torch.set_grad_enabled(False)
-
 
 class GnnGenerator:
     def __init__(self, src_file=None, col=None, dest_file=None, json_file=None, subs_file=None, embeddings=None,
                  pos=None, antonyms=None, gnn_model_file=None, predictor_path=None, edge_filter=None,
-                 optimal_threshold=None, use_contrastive_prob=None):
+                 optimal_threshold=None, use_contrastive_prob=None, compile_predictor=None, workers=None,
+                 quantize=None):
         """
         A class that generates edits using a pretrained GNN model to solve RLAP.
 
@@ -103,6 +111,9 @@ class GnnGenerator:
         :param edge_filter: a boolean value specifying whether to use pos-based edge filtering in the graph creation
         :param optimal_threshold:  whether to use optimal threshold for upper limit of substitutions
         :param use_contrastive_prob: whether to use contrastive probability as beam search criterion
+        :param compile_predictor: whether to compile the classifier with torch.compile before beam search
+        :param workers: number of processes used for pos tagging the sentences, defaults to a single process
+        :param quantize: whether to quantize the classifier to int8 with onnxruntime, when no gpu is available
         """
 
         if src_file is None:
@@ -114,7 +125,9 @@ class GnnGenerator:
         if col is None:
             print("[ERROR]: col must be specified")
             exit(1)
-        self.sentences = pd.read_csv(src_file)[[col]]
+        # read only the sentences column, in chunks, so that peak memory stays bounded for large corpora
+        self.sentences = pd.concat([c[[col]] for c in pd.read_csv(src_file, usecols=[col], chunksize=100_000)],
+                                   ignore_index=True)
 
         if gnn_model_file is None and subs_file is None:
             print("[ERROR]: gnn_model_file or subs_file must be specified")
@@ -123,8 +136,9 @@ class GnnGenerator:
             print("[ERROR]: File {} does not exist".format(gnn_model_file))
             exit(1)
         self.gnn_model = Model(layer_num=5, edge_dim=16, node_dim=8)
-        self.gnn_model.load_state_dict(torch.load(gnn_model_file))
-        self.gnn_model.cuda()
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.gnn_model.load_state_dict(torch.load(gnn_model_file, map_location=device))
+        self.gnn_model.to(device)
         self.gnn_model.eval()
 
         if predictor_path is None:
@@ -134,8 +148,24 @@ class GnnGenerator:
             print("[ERROR]: File {} does not exist".format(predictor_path))
             exit(1)
         self.predictor = DistilBertForSequenceClassification.from_pretrained(predictor_path)
+        self.predictor.eval()
+        if torch.cuda.is_available():
+            self.predictor = self.predictor.cuda().half()
         self.tokenizer = DistilBertTokenizerFast.from_pretrained("distilbert-base-uncased")
 
+        # tokenize the whole corpus in a single call, instead of encoding each original sentence separately; the
+        # encodings are kept unpadded and each batch is padded only when it is given to the predictor
+        self.encodings = self.tokenizer(list(self.sentences[col]), truncation=True)
+
+        if quantize and torch.cuda.is_available():
+            print("[INFO]: cuda is available, so the predictor will not be quantized")
+        elif quantize:
+            self.predictor = self.quantize_predictor(predictor_path)
+        if compile_predictor and not isinstance(self.predictor, torch.nn.Module):
+            print("[INFO]: the quantized predictor can not be compiled")
+        elif compile_predictor:
+            self.predictor = torch.compile(self.predictor, mode='reduce-overhead', fullgraph=False)
+
         self.substitutions = None
         if subs_file is not None:
             if not os.path.exists(subs_file):
@@ -159,10 +189,66 @@ class GnnGenerator:
         self.edge_filter = edge_filter if edge_filter is not None else False
         self.opt_th = optimal_threshold if optimal_threshold is not None else False
         self.use_contrastive_prob = use_contrastive_prob if use_contrastive_prob is not None else False
+        self.workers = workers if workers is not None else 1
 
         self.edits = None
         self.subs_dict = None
 
+    def quantize_predictor(self, predictor_path, n_calibration=100):
+        """
+        A method that exports the classifier to onnx and applies static int8 quantization to its Add and MatMul
+        operators, calibrated on the first sentences of the source file. The quantization config is chosen from the
+        instruction sets of the host cpu (arm64, avx512_vnni, avx512 or avx2). It requires optimum[onnxruntime].
+
+        :param predictor_path: string representing the directory where the pretrained classifier is stored
+        :param n_calibration: the number of sentences used for calibrating the quantization ranges
+        :return: ORTModelForSequenceClassification with the quantized classifier
+        """
+
+        try:
+            from datasets import Dataset
+            from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoCalibrationConfig, AutoQuantizationConfig
+        except ImportError:
+            print("[ERROR]: optimum[onnxruntime] must be installed to quantize the predictor")
+            exit(1)
+
+        print("[INFO]: Quantizing predictor to int8...")
+        cpu_flags = []
+        if os.path.exists('/proc/cpuinfo'):
+            with open('/proc/cpuinfo', 'r') as f:
+                cpu_flags = f.read().split()
+
+        operators = ['Add', 'MatMul']
+        if platform.machine().lower() in ('aarch64', 'arm64'):
+            qconfig = AutoQuantizationConfig.arm64(is_static=True, per_channel=False, operators_to_quantize=operators)
+        elif 'avx512_vnni' in cpu_flags:
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=True, per_channel=False,
+                                                         operators_to_quantize=operators)
+        elif 'avx512f' in cpu_flags:
+            qconfig = AutoQuantizationConfig.avx512(is_static=True, per_channel=False, reduce_range=True,
+                                                    operators_to_quantize=operators)
+        else:
+            qconfig = AutoQuantizationConfig.avx2(is_static=True, per_channel=False, reduce_range=True,
+                                                  operators_to_quantize=operators)
+
+        onnx_model = ORTModelForSequenceClassification.from_pretrained(predictor_path, export=True)
+        quantizer = ORTQuantizer.from_pretrained(onnx_model)
+
+        calibration_sents = list(self.sentences.iloc[:n_calibration, 0])
+        calibration_dataset = Dataset.from_dict(dict(self.tokenizer(calibration_sents, truncation=True)))
+        calibration_config = AutoCalibrationConfig.minmax(calibration_dataset)
+        ranges = quantizer.fit(dataset=calibration_dataset, calibration_config=calibration_config,
+                               operators_to_quantize=qconfig.operators_to_quantize)
+
+        # the onnxruntime session reads the quantized model when it is created, so the directory can be removed after
+        with tempfile.TemporaryDirectory(prefix='quantized_predictor_') as save_dir:
+            quantizer.quantize(save_dir=save_dir, quantization_config=qconfig, calibration_tensors_range=ranges)
+            quantized_model = ORTModelForSequenceClassification.from_pretrained(save_dir,
+                                                                                file_name='model_quantized.onnx')
+
+        return quantized_model
+
     def generate_counterfactuals(self):
         """
         A method that generates counterfactuals using a bipartite graph, a pretrained GNN model and beam search.
@@ -173,7 +259,7 @@ class GnnGenerator:
 
         gnn_editor = GnnEditor(data=self.sentences, gnn_model=self.gnn_model, predictor=self.predictor,
                                tokenizer=self.tokenizer, pos=self.pos, antonyms=self.antonyms, subs=self.substitutions,
-                               word_embeddings=self.embeddings)
+                               word_embeddings=self.embeddings, encodings=self.encodings, workers=self.workers)
         self.edits, self.subs_dict = gnn_editor.pipeline(edge_filter=self.edge_filter, opt_th=self.opt_th,
                                                          use_contrastive_prob=self.use_contrastive_prob)
 
@@ -186,16 +272,36 @@ class GnnGenerator:
         :return: GnnGenerator object
         """
 
-        print("[INFO]: Exporting generated counterfactuals to {}...".format(self.dest_file))
-        self.edits.to_csv(self.dest_file, index=False)
+        # write the substitution dictionary in a background thread, while the edits are written to the csv file
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            json_future = None
+            if self.json_file is not None:
+                print("[INFO]: Exporting substitution dictionary to {}...".format(self.json_file))
+                json_future = executor.submit(self.export_subs_dict)
+
+            print("[INFO]: Exporting generated counterfactuals to {}...".format(self.dest_file))
+            # stream the rows with the csv module, instead of building the whole csv text in memory with pandas
+            with open(self.dest_file, 'w', newline='', buffering=1 << 22) as f:
+                writer = csv.writer(f, lineterminator=os.linesep)
+                writer.writerow(self.edits.columns)
+                writer.writerows(self.edits.itertuples(index=False, name=None))
 
-        if self.json_file is not None:
-            print("[INFO]: Exporting substitution dictionary to {}...".format(self.json_file))
-            with open(self.json_file, 'w') as f:
-                json.dump(self.subs_dict, f)
+            # re-raise any error of the json export
+            if json_future is not None:
+                json_future.result()
 
         return self
 
+    def export_subs_dict(self):
+        """
+        A method that exports the substitution dictionary to a json file.
+
+        :return: None
+        """
+
+        with open(self.json_file, 'w', buffering=1 << 20) as f:
+            json.dump(self.subs_dict, f)
+
     def pipeline(self):
         """
         A method that executes the pipeline for generating counterfactuals using a bipartite graph and a pretrained gnn
@@ -240,6 +346,14 @@ def parse_input(args=None):
                         help="Whether to use optimal threshold for upper limit of substitutions")
     parser.add_argument("--use-contrastive-prob", action='store_true', required=False,
                         help="Whether to use contrastive probability as beam search criterion")
+    parser.add_argument("--compile", action='store_true', required=False,
+                        help="Whether to compile the classifier with torch.compile")
+    parser.add_argument("-w", "--workers", action='store', metavar="workers", type=int, required=False,
+                        help="The number of processes used for pos tagging the sentences (default: 1); each "
+                             "process loads its own spacy model")
+    parser.add_argument("--quantize", action='store_true', required=False,
+                        help="Whether to quantize the classifier to int8 when no gpu is available, with a config "
+                             "chosen from the cpu (arm64, avx512_vnni, avx512 or avx2)")
 
     return parser.parse_args(args)
 
@@ -251,7 +365,8 @@ def main(args):
                              subs_file=args.subs_file, embeddings=args.embeddings, pos=args.pos, antonyms=args.antonyms,
                              gnn_model_file=args.gnn_model_file, predictor_path=args.predictor_path,
                              edge_filter=args.edge_filter, optimal_threshold=args.optimal_threshold,
-                             use_contrastive_prob=args.use_contrastive_prob)
+                             use_contrastive_prob=args.use_contrastive_prob, compile_predictor=args.compile,
+                             workers=args.workers, quantize=args.quantize)
 
     generator.pipeline()
 
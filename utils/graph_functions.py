@@ -4,7 +4,10 @@ Created 10 February 2024
 Description: A python file containing assisting functions for the bipartite graph
 """
 
+import os
 import math
+import functools
+import multiprocessing
 
 import spacy
 import torch
@@ -18,6 +21,7 @@ from operator import itemgetter
 from tqdm import tqdm
 from networkx.algorithms import bipartite
 from scipy.spatial.distance import cosine
+from concurrent.futures import ProcessPoolExecutor
 
 nlp = spacy.load('en_core_web_sm')
 
@@ -114,14 +118,27 @@ def list_diff(l1, l2):
     return diff
 
 
+@functools.lru_cache(maxsize=100_000)
+def cached_synsets(word, pos=None):
+    """
+    Get the wordnet synsets of a word, memoizing the result since the same words are looked up many times.
+
+    :param word: the word whose synsets will be returned
+    :param pos: wordnet pos tag ('a', 'v', 'n', ...) of the synsets, or None for all pos tags
+    :return: tuple with the synsets of the word
+    """
+    return tuple(wn.synsets(word, pos=pos))
+
+
 def get_synsets(syn, pos, return_index=False):
     all_syn = []
     indices = []
     d = dict()
     p = pos[0] if pos is not None else None
     for idx, i in enumerate(syn):
-        if wn.synsets(i, pos=p):
-            s = wn.synsets(i, pos=p)[0]
+        synsets = cached_synsets(i, p)
+        if synsets:
+            s = synsets[0]
             all_syn.append(s)
             d[s] = i
             indices.append(idx)
@@ -131,13 +148,25 @@ def get_synsets(syn, pos, return_index=False):
         return all_syn, d
 
 
-def get_antonym(given_word):
+@functools.lru_cache(maxsize=100_000)
+def cached_antonyms(given_word):
+    """
+    Get the antonyms of a word, memoizing the result so that each word is resolved in wordnet only once.
+
+    :param given_word: the word whose antonyms will be returned
+    :return: tuple with the unique antonyms of the word
+    """
     antonyms = []
-    for syn in wn.synsets(given_word):
+    for syn in cached_synsets(given_word):
         for lem in syn.lemmas():
-            if lem.antonyms() and lem.antonyms()[0].synset().pos() == lem.synset().pos():
-                antonyms.append(lem.antonyms()[0].name())
-    return list(set(antonyms))   # remove duplicates and return the list
+            lem_antonyms = lem.antonyms()
+            if lem_antonyms and lem_antonyms[0].synset().pos() == lem.synset().pos():
+                antonyms.append(lem_antonyms[0].name())
+    return tuple(set(antonyms))   # remove duplicates
+
+
+def get_antonym(given_word):
+    return list(cached_antonyms(given_word))
 
 
 def get_antonym_list(words):
@@ -259,6 +288,78 @@ def get_cos_similarity(synset0, synset1, word0, word1, model, tokenizer):
     return cos_sim if synset0.pos() == synset1.pos() else 10
 
 
+def get_word_embeddings(words, model, tokenizer, batch_size=64):
+    """
+    Get the embeddings of the given words, computing each of them once and in batches, instead of once per word pair.
+
+    :param words: list of unique words
+    :param model: pretrained llm model used to get wordvectors
+    :param tokenizer: pretrained tokenizer used to get wordvectors
+    :param batch_size: the number of words given to the model in each forward pass
+    :return: tensor of shape (number of words, embedding dimension) with the embedding of each word
+    """
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    embeddings = []
+    for i in range(0, len(words), batch_size):
+        inputs = tokenizer(words[i:i+batch_size], padding=True, return_tensors="pt").to(device)
+        with torch.inference_mode():
+            embeddings.append(model(**inputs).last_hidden_state[:, 0, :].to('cpu'))
+
+    return torch.cat(embeddings, dim=0)
+
+
+def lookup_word_embeddings(words, word_embeddings):
+    """
+    Get the precomputed embeddings of the given words.
+
+    :param words: list of words
+    :param word_embeddings: dictionary containing word embeddings
+    :return: tensor of shape (number of words, embedding dimension) with the embedding of each word (zeros for the
+    words without an embedding), and boolean tensor denoting which words have an embedding
+    """
+
+    dim = len(next(iter(word_embeddings.values())))
+    found = torch.tensor([w in word_embeddings for w in words], dtype=torch.bool)
+    vectors = torch.tensor([word_embeddings[w] if w in word_embeddings else [0.0] * dim for w in words],
+                           dtype=torch.float32)
+
+    return vectors, found
+
+
+def cos_distance_matrix(vectors0, vectors1):
+    """
+    Get the cosine distance between all pairs of the given vectors, made positive (bounded in 0 and 2) as in
+    get_cos_similarity.
+
+    :param vectors0: tensor of shape (n0, embedding dimension)
+    :param vectors1: tensor of shape (n1, embedding dimension)
+    :return: tensor of shape (n0, n1) with the distance of every pair of vectors
+    """
+
+    similarity = torch.nn.functional.normalize(vectors0, dim=1) @ torch.nn.functional.normalize(vectors1, dim=1).T
+
+    # 2 - cosine distance = 1 + cosine similarity
+    return 1 + similarity
+
+
+def pos_mismatch_matrix(synsets0, synsets1):
+    """
+    Get which pairs of the given synsets have different pos tags, to be used for edge filtering.
+
+    :param synsets0: list of wordnet synsets
+    :param synsets1: list of wordnet synsets
+    :return: boolean tensor of shape (len(synsets0), len(synsets1))
+    """
+
+    pos_ids = dict()
+    pos0 = torch.tensor([pos_ids.setdefault(s.pos(), len(pos_ids)) for s in synsets0], dtype=torch.long)
+    pos1 = torch.tensor([pos_ids.setdefault(s.pos(), len(pos_ids)) for s in synsets1], dtype=torch.long)
+
+    return pos0[:, None] != pos1[None, :]
+
+
 def get_distance(synset0, synset1):
     if synset0.pos() == synset1.pos() and synset0 != synset1:
         sim = synset0.path_similarity(synset1)
@@ -329,10 +430,59 @@ def most_dissimilar_pair(substitution_synsets, d0, d1):
     return subs_pair
 
 
-def create_attributes_list(sentences):
+def tag_sentence(sentence, tag_funcs):
+    return tuple(tag_func(sentence) for tag_func in tag_funcs)
+
+
+def tag_sentences(tag_funcs, sentences, n_workers=1, min_shard_size=256):
+    """
+    A function that applies the given check_if_* pos tagging functions to every sentence in a single pass, in one
+    process pool if more than one worker is requested, since the tagging of each sentence is independent of the others.
+
+    :param tag_funcs: list of functions that take as input a sentence and return its pos tagged words
+    :param sentences: list containing the sentences
+    :param n_workers: the number of worker processes, capped to the number of cpus
+    :param min_shard_size: the minimum number of sentences given to each worker
+    :return: list with the outputs of each tag function for every sentence, in the order of the sentences
+    """
+
+    n_workers = min(n_workers, os.cpu_count() or 1, math.ceil(len(sentences) / min_shard_size))
+    if n_workers <= 1:
+        tags = [tag_sentence(s, tag_funcs) for s in sentences]
+    else:
+        # the workers only need spacy, so they are spawned instead of forked from a process that may already use cuda
+        # and the tokenizers thread pool
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            tags = list(executor.map(functools.partial(tag_sentence, tag_funcs=tag_funcs), sentences,
+                                     chunksize=math.ceil(len(sentences) / (4 * n_workers))))
+
+    return [[sentence_tags[i] for sentence_tags in tags] for i in range(len(tag_funcs))]
+
+
+def create_pos_lists(sentences, pos_list, n_workers=1):
+    """
+    A function that creates the word lists of the given parts-of-speech, tagging the sentences for all of them at once.
+
+    :param sentences: list containing the sentences
+    :param pos_list: list with the parts-of-speech ('adj', 'verb' or 'noun') of the word lists
+    :param n_workers: the number of processes used for pos tagging the sentences
+    :return: list with the word list of each part-of-speech, the same as the one of the respective create_*_list
+    """
+
+    tag_funcs = {'adj': check_if_attribute, 'verb': check_if_verb, 'noun': check_if_noun}
+    list_funcs = {'adj': create_attributes_list, 'verb': create_verb_list, 'noun': create_singular_list}
+
+    all_tags = tag_sentences([tag_funcs[pos] for pos in pos_list], sentences, n_workers=n_workers)
+
+    return [list_funcs[pos](sentences, tags=tags) for pos, tags in zip(pos_list, all_tags)]
+
+
+def create_attributes_list(sentences, tags=None):
+    if tags is None:
+        tags = [check_if_attribute(s) for s in sentences]
+
     all_attributes = []
-    for s in sentences:
-        attribute, new_s = check_if_attribute(s)
+    for attribute, new_s in tags:
         all_attributes.append(attribute)
 
     attributes = [item for sublist in all_attributes for item in sublist]
@@ -362,13 +512,15 @@ def graph_adjective_substitutions(sentences, pos, baseline=True, antonyms=False)
         return wn_hierarchy(attributes, attributes, pos, baseline)
 
 
-def create_verb_list(sentences):
+def create_verb_list(sentences, tags=None):
+    if tags is None:
+        tags = [check_if_verb(s) for s in sentences]
+
     all_vbp = []
     all_vbg = []
     all_vb = []
 
-    for s in sentences:
-        vbp, vbg, vb, new_s = check_if_verb(s)
+    for vbp, vbg, vb, new_s in tags:
         all_vbp.append(vbp)
         all_vbg.append(vbg)
         all_vb.append(vb)
@@ -410,12 +562,14 @@ def graph_verb_substitutions(sentences, pos, baseline=True, antonyms=False):
         return wn_hierarchy(verb_list, verb_list, pos, baseline)
 
 
-def create_singular_list(sentences):
+def create_singular_list(sentences, tags=None):
+    if tags is None:
+        tags = [check_if_noun(s) for s in sentences]
+
     all_singulars = []
     # all_plurals = []
 
-    for s in sentences:
-        singular, plural, new_s = check_if_noun(s)
+    for singular, plural, new_s in tags:
         all_singulars.append(singular)
         # all_plurals.append(plural)
 
@@ -61,7 +61,7 @@ def sent_scoring(model, tokenizer, text, cuda=False):
     if cuda:
         tokens.to('cuda')
 
-    with torch.no_grad():
+    with torch.inference_mode():
         outputs = model(tokens, labels=tokens)
 
     loss, logits = outputs[:2]
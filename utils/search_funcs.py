@@ -4,9 +4,33 @@ Created 16 April 2024
 Description: A python file containing beam search and assisting function
 """
 
+import math
+import numba
+import numpy as np
+
 from utils.llm_functions import *
 
 
+def predictor_forward(model, encoded_text):
+    """
+    A function that runs a forward pass of the given classifier on the device where the classifier is stored. When the
+    classifier is on gpu, the forward pass runs under fp16 autocast.
+
+    :param model: a pretrained model used for prediction
+    :param encoded_text: dictionary containing the input_ids and the attention_mask of the encoded texts
+
+    :return: the fp32 logits of the model
+    """
+    device = model.device
+    inputs = {k: v.to(device, non_blocking=True) for k, v in encoded_text.items()}
+
+    with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.float16,
+                                                enabled=device.type == 'cuda'):
+        output = model(**inputs)
+
+    return output.logits.float()
+
+
 def get_prediction(model, tokenizer, text, return_logits=False):
     """
     A function that takes as input a model, a tokenizer and a text and returns the prediction of the model.
@@ -20,13 +44,133 @@ def get_prediction(model, tokenizer, text, return_logits=False):
     """
     # get encoded input tokens from text
     encoded_text = tokenizer(text, padding=True, truncation=True, return_tensors='pt')
-    with torch.no_grad():
-        output = model(**encoded_text)
+    logits = predictor_forward(model, encoded_text)
+
+    return logits if return_logits else torch.argmax(logits).item()
+
+
+def get_batch_logits(model, tokenizer, encoded_text, batch_size=64):
+    """
+    A function that takes as input a model, a tokenizer and already encoded texts, and returns the logits of the model
+    for every text, computed in batches.
+
+    :param model: a pretrained model used for prediction
+    :param tokenizer: the tokenizer used for padding each batch
+    :param encoded_text: the unpadded tokenizer output (lists of input_ids and attention_mask) of all texts
+    :param batch_size: the number of texts given to the model in each forward pass
+
+    :return: tensor of shape (number of texts, number of classes) containing the logits of the model
+    """
+    n_texts = len(encoded_text['input_ids'])
+
+    logits = []
+    for i in range(0, n_texts, batch_size):
+        # pad each batch only to its own longest text, rounded up to a multiple of 8 so that the cuda graphs of a
+        # compiled predictor are reused across batches
+        batch = tokenizer.pad({k: v[i:i+batch_size] for k, v in encoded_text.items()}, padding=True,
+                              pad_to_multiple_of=8, return_tensors='pt')
+        logits.append(predictor_forward(model, batch))
+
+    return torch.cat(logits, dim=0)
+
+
+def encode_substitutions(words, substitutions):
+    """
+    A function that maps the words of a sentence, and every word they can be substituted with, to integer ids, so that
+    beam search candidates can be represented as arrays of word ids.
+
+    :param words: list with the words of the sentence
+    :param substitutions: dictionary with the all possible substitutions
+
+    :return: array with the word of each id, int32 array with the ids of the sentence words and int32 array with the id
+    of the substitute of each id (equal to the id itself if the word has no substitute)
+    """
+    vocab = dict()
+    vocab_words = []
+    for word in words:
+        if word not in vocab:
+            vocab[word] = len(vocab_words)
+            vocab_words.append(word)
+
+    # follow the substitutions of the substitutes as well, since a substituted word can be substituted again
+    i = 0
+    while i < len(vocab_words):
+        sub_word = substitutions.get(vocab_words[i], vocab_words[i])
+        if sub_word not in vocab:
+            vocab[sub_word] = len(vocab_words)
+            vocab_words.append(sub_word)
+        i += 1
+
+    token_ids = np.array([vocab[word] for word in words], dtype=np.int32)
+    sub_ids = np.array([vocab[substitutions.get(word, word)] for word in vocab_words], dtype=np.int32)
 
-    return output.logits if return_logits else torch.argmax(output.logits).item()
+    return np.array(vocab_words, dtype=object), token_ids, sub_ids
 
 
-def beam_search(text, substitutions, original_probs, original_fluency, model=None, tokenizer=None,
+@numba.njit(cache=True)
+def expand_candidate(candidate, prev_sub_idx, sub_ids):
+    """
+    A function that creates all the new candidates of beam search from a given one, each substituting a different
+    word after the last substituted position.
+
+    :param candidate: int32 array with the word ids of the candidate
+    :param prev_sub_idx: the last substituted position of the candidate
+    :param sub_ids: int32 array with the id of the substitute of each word id
+
+    :return: int32 array of shape (number of new candidates, number of words) with the word ids of the new candidates,
+    and int64 array with the substituted position of each new candidate
+    """
+    n_words = candidate.shape[0]
+    sub_positions = np.empty(max(n_words - prev_sub_idx, 0), dtype=np.int64)
+    n_cands = 0
+    for pos in range(prev_sub_idx, n_words):
+        if sub_ids[candidate[pos]] != candidate[pos]:
+            sub_positions[n_cands] = pos
+            n_cands += 1
+    sub_positions = sub_positions[:n_cands]
+
+    new_tokens = np.empty((n_cands, n_words), dtype=np.int32)
+    for i in range(n_cands):
+        new_tokens[i, :] = candidate
+        new_tokens[i, sub_positions[i]] = sub_ids[candidate[sub_positions[i]]]
+
+    return new_tokens, sub_positions
+
+
+@numba.njit(cache=True)
+def prune_candidates(new_tokens, sub_positions, scores, beam_size, rank, sub_ids):
+    """
+    A function that selects the top b new candidates of beam search, and checks which of them can be expanded
+    further, i.e. which have a word with a substitute after their last substituted position.
+
+    :param new_tokens: int32 array of shape (number of candidates, number of words) with the word ids of the candidates
+    :param sub_positions: int64 array with the last substituted position of each candidate
+    :param scores: float32 array with the contrastive probability of each candidate
+    :param beam_size: the size of the beam
+    :param rank: whether to rank the candidates by score, otherwise the first b candidates are kept
+    :param sub_ids: int32 array with the id of the substitute of each word id
+
+    :return: int64 array with the indices of the selected candidates, and boolean array denoting whether each of
+    them can be expanded
+    """
+    k = min(beam_size, scores.shape[0])
+    if rank:
+        top_idx = np.argsort(-scores, kind='mergesort')[:k]
+    else:
+        top_idx = np.arange(k)
+
+    live = np.zeros(k, dtype=np.bool_)
+    for j in range(k):
+        i = top_idx[j]
+        for pos in range(sub_positions[i], new_tokens.shape[1]):
+            if sub_ids[new_tokens[i, pos]] != new_tokens[i, pos]:
+                live[j] = True
+                break
+
+    return top_idx, live
+
+
+def beam_search(text, substitutions, original_logits, original_fluency, model=None, tokenizer=None,
                 fluency_model=None, fluency_tokenizer=None, beam_size=5, max_subs=10, use_contrastive_prob=False):
     """
     A function that uses beam search to create appropriate adversarials based on a given text.
@@ -35,7 +179,7 @@ def beam_search(text, substitutions, original_probs, original_fluency, model=Non
 
     :param text: string representing the original sentence
     :param substitutions: dictionary with the all possible substitutions
-    :param original_probs: the predicted logits of the original sentence
+    :param original_logits: the predicted logits of the original sentence
     :param original_fluency: the fluency of the original sentence
     :param model: the model used for prediction
     :param tokenizer: the tokenizer used for prediction
@@ -53,64 +197,95 @@ def beam_search(text, substitutions, original_probs, original_fluency, model=Non
         fluency_model, fluency_tokenizer = model_init('t5-base', cuda=not torch.cuda.is_available())
 
     # get the original prediction
-    original_pred = torch.argmax(original_probs).item()
+    original_pred = torch.argmax(original_logits).item()
+    original_log_prob = torch.log_softmax(original_logits, dim=-1)[original_pred]
     sent = text.lower()
-    cand_set = {(sent, 0, 0)}
+    vocab_words, sent_tokens, sub_ids = encode_substitutions(sent.split(), substitutions)
+    compiled = isinstance(model, torch._dynamo.OptimizedModule)
+
+    # the beams are stored as separate arrays for their word ids, last substituted position and contrastive probability,
+    # along with whether they are live (can still be expanded) or done (terminal, kept only for the final selection);
+    # at most beam_size beams are added at each of the max_subs steps
+    max_beams = 1 + max_subs * beam_size
+    beam_tokens = np.empty((max_beams, sent_tokens.size), dtype=np.int32)
+    beam_positions = np.zeros(max_beams, dtype=np.int64)
+    beam_scores = np.zeros(max_beams, dtype=np.float32)
+    beam_live = np.zeros(max_beams, dtype=np.bool_)
+    beam_done = np.zeros(max_beams, dtype=np.bool_)
+
+    beam_tokens[0] = sent_tokens
+    beam_live[0] = True
+    n_beams = 1
     counter = 0
-    new_candidates = []
-
-    while counter < max_subs and cand_set:
-
-        elem = cand_set.pop()
-        candidate, prev_sub_idx, _ = elem
-        candidate = candidate.split()
-
-        for idx, word in enumerate(candidate[prev_sub_idx:]):
-            new_cand = candidate.copy()
-            new_cand[prev_sub_idx+idx] = substitutions.get(word, word)
-            new_cand_str = " ".join(new_cand)
-
-            # check if the new candidate is different from the original sentence
-            if new_cand_str != " ".join(candidate):
-                contrastive_prob = 0
-
-                # get the prediction of the new candidate if a model is provided
-                if model is not None and tokenizer is not None:
-                    logits = get_prediction(model, tokenizer, new_cand_str, return_logits=True)
-                    probs = torch.softmax(logits, dim=1)[0]
-                    new_pred = torch.argmax(logits).item()
-
-                    # if prediction is flipped, return the new candidate
-                    if new_pred != original_pred:
-                        return new_cand_str
-
-                    # compute contrastive probability
-                    if use_contrastive_prob:
-                        contrastive_prob = original_probs[original_pred] - probs[original_pred]
-
-                # else, add it to the candidate list
-                new_candidates.append((new_cand_str, prev_sub_idx+idx, contrastive_prob))
-
-        # sort the new candidates based on contrastive probability and add the top b to the next round
-        if new_candidates:
-            new_candidates = sorted(
-                new_candidates,
-                key=lambda x: x[2],
-                reverse=True
-            )
-            cand_set = cand_set.union(new_candidates[:min(beam_size, len(new_candidates))])
-        else:
-            break
+
+    # the word ids of every candidate scored in this search, so that no candidate is given to the predictor twice
+    seen = {sent_tokens.tobytes()}
+
+    while counter < max_subs and beam_live.any():
+
+        # expand the live beam with the highest contrastive probability
+        beam_idx = np.argmax(np.where(beam_live, beam_scores, -np.inf))
+        beam_live[beam_idx] = False
+
+        # create all the new candidates at once, each one substituting a different word after the last substitution
+        new_tokens, sub_positions = expand_candidate(beam_tokens[beam_idx], beam_positions[beam_idx], sub_ids)
+
+        # skip the candidates that were already created through a different sequence of substitutions
+        unseen = []
+        for i in range(new_tokens.shape[0]):
+            key = new_tokens[i].tobytes()
+            if key not in seen:
+                seen.add(key)
+                unseen.append(i)
+        unseen = np.array(unseen, dtype=np.int64)
+        new_tokens, sub_positions = new_tokens[unseen], sub_positions[unseen]
+        if sub_positions.size == 0:
+            continue
+        scores = np.zeros(sub_positions.size, dtype=np.float32)
+
+        # get the predictions of all the new candidates in a single forward pass, if a model is provided
+        if model is not None and tokenizer is not None:
+            new_texts = [" ".join(vocab_words[row]) for row in new_tokens]
+            n_cands = len(new_texts)
+            batch_texts = new_texts
+            if compiled:
+                # pad both the number of candidates (by repeating the first one) and their length to a multiple of 8,
+                # so that candidate batches share a few shapes and the cuda graphs of the compiled predictor are
+                # replayed instead of recaptured; the logits of the padding rows are dropped
+                batch_texts = new_texts + new_texts[:1] * (8 * math.ceil(n_cands / 8) - n_cands)
+            encoded_cands = tokenizer(batch_texts, padding=True, truncation=True,
+                                      pad_to_multiple_of=8 if compiled else None, return_tensors='pt')
+            logits = predictor_forward(model, encoded_cands)[:n_cands]
+            new_preds = torch.argmax(logits, dim=1)
+
+            # if prediction is flipped, return the first flipped candidate
+            flipped = torch.nonzero(new_preds != original_pred)
+            if flipped.numel() > 0:
+                return new_texts[flipped[0].item()]
+
+            # compute contrastive probability in log-space; log-softmax is monotonic in the softmax probability, so
+            # the ranking of the candidates (and their order relative to the original sentence) is preserved
+            if use_contrastive_prob:
+                log_probs = torch.log_softmax(logits, dim=1)
+                scores = (original_log_prob - log_probs[:, original_pred]).cpu().numpy()
+
+        # keep the top b new candidates based on contrastive probability for the next round (if contrastive
+        # probability is not used, all candidates have the same score, so the first b are kept); terminal candidates
+        # are kept only for the final selection, so that they do not waste a step
+        top_idx, live = prune_candidates(new_tokens, sub_positions, scores, beam_size, use_contrastive_prob, sub_ids)
+        new_beams = slice(n_beams, n_beams + top_idx.size)
+        beam_tokens[new_beams] = new_tokens[top_idx]
+        beam_positions[new_beams] = sub_positions[top_idx]
+        beam_scores[new_beams] = scores[top_idx]
+        beam_live[new_beams] = live
+        beam_done[new_beams] = ~live
+        n_beams += top_idx.size
 
         counter += 1  # update counter value
-        new_candidates = []  # reset the new candidates list
 
     # if no adversarial is found, return the best candidate based on contrastive probability
-    try:
-        best_cand = max(cand_set,
-                        key=lambda x: x[2]
-                        )[0]
-    except ValueError:
-        best_cand = sent
-
-    return best_cand
+    kept = beam_live | beam_done
+    if not kept.any():
+        return sent
+
+    return " ".join(vocab_words[beam_tokens[np.argmax(np.where(kept, beam_scores, -np.inf))]])